@@ -5,17 +5,25 @@ from ninja_syntax import Writer
 
 IS_DEBUG = True
 BUILD_EXAMPLES = True
+# tune release builds for the host cpu. Binaries built this way may not run on
+# other machines, so it is opt-in: FRAMEBUFFER_NATIVE=1 ./configure.py
+IS_NATIVE = os.environ.get('FRAMEBUFFER_NATIVE') == '1'
 
 # process is_debug flags
 cflags = ['-Wall', '-Werror']
 cppflags = []
+ldflags = []
 
 if IS_DEBUG:
     cflags += ['-g']
     cppflags += ['-g']
 else:
-    cflags += ['-O3']
-    cppflags += ['-O3']
+    release_flags = ['-O3', '-flto', '-fno-plt', '-DNDEBUG']
+    if IS_NATIVE:
+        release_flags += ['-march=native', '-mtune=native']
+    cflags += release_flags
+    cppflags += release_flags
+    ldflags += ['-flto']
 
 # process build_examples
 dirs = ['lib']
@@ -27,6 +35,7 @@ ninja = Writer(output=open('build.ninja', 'w'))
 
 ninja.variable('cflags', ' '.join(cflags))
 ninja.variable('cppflags', ' '.join(cflags))
+ninja.variable('ldflags', ' '.join(ldflags))
 ninja.newline()
 ninja.variable('cc', 'gcc')
 ninja.variable('cxx', 'g++')
@@ -38,7 +47,7 @@ ninja.rule('cc',
            )
 
 ninja.rule('cc-shared',
-           command='$cc $cflags -shared $in -o $out',
+           command='$cc $cflags $ldflags -shared $in -o $out',
            description='cc $out',
            )
 
@@ -46,6 +55,11 @@ ninja.rule('cxx',
            command='$cxx $cppflags -c $in -o $out',
            description='cxx $out',
            )
+
+ninja.rule('cxx-shared',
+           command='$cxx $cppflags $ldflags -shared $in -o $out',
+           description='cxx $out',
+           )
 ninja.rule('configure',
            command='./$in $out',
            description='configure $out',
@@ -3,17 +3,36 @@
 """reads from the buffer created by webcam.py"""
 
 import cv2
-import time
+import os
+import sys
+from time import time_ns
 from accessor import BufferedFrameReader
 
+# how often the latency readout is refreshed
+PRINT_INTERVAL_MS = 500
+
+# best effort: pin playback to its own core with real-time priority, see webcam.py
+CPU_CORES = {1}
+try:
+    if CPU_CORES <= os.sched_getaffinity(0):
+        os.sched_setaffinity(0, CPU_CORES)
+    os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(20))
+except (AttributeError, OSError):
+    pass
+
 reader = BufferedFrameReader('webcam')
+write, flush = sys.stdout.write, sys.stdout.flush
 
 print('started video playback')
+last_print = 0
 try:
     while True:
         frame, acq_time = reader.get_next_frame()
-        now = int(time.time() * 1000)
-        print(f'\rlatency ms: {now -acq_time}    ', end='')
+        now = time_ns() // 1_000_000
+        if now - last_print > PRINT_INTERVAL_MS:
+            write(f'\rlatency ms: {now -acq_time}    ')
+            flush()
+            last_print = now
 
         cv2.imshow('camera', frame)
         key = cv2.waitKey(1)
@@ -3,21 +3,43 @@
 """creates a buffer named webcam"""
 
 import cv2
-import time
+import os
+import numpy as np
+from time import time_ns
 from accessor import BufferedFrameWriter
 
-writer = BufferedFrameWriter('webcam')
+# best effort: keep the capture loop and writer thread off core 0, which usually
+# services IRQs, and give them real-time priority so jitter does not drop frames
+CPU_CORES = {2, 3}
+try:
+    if CPU_CORES <= os.sched_getaffinity(0):
+        os.sched_setaffinity(0, CPU_CORES)
+    os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(20))
+except (AttributeError, OSError):
+    pass
+
+# the copy into the buffer runs on a worker thread, overlapping the next grab
+writer = BufferedFrameWriter('webcam', threaded=True)
 
 vc = cv2.VideoCapture(0)
 
+# probe one frame to learn the capture shape, then let OpenCV decode every
+# following frame into preallocated arrays. Two are needed since the writer
+# may still be copying the previous one.
+_, probe = vc.read()
+frames = [np.empty(probe.shape, dtype=np.uint8) for _ in range(2)]
+idx = 0
+
 try:
     print('started video capture')
     while True:
-        _, frame = vc.read()
-        writer.write_frame(frame, int(time.time() * 1000))
+        _, frame = vc.read(frames[idx])
+        writer.write_frame(frame, time_ns() // 1_000_000)
+        idx ^= 1
 except KeyboardInterrupt:
     pass
 
 vc.release()
+writer.close()
 cv2.destroyAllWindows()
 print('all cleaned up')
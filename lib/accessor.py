@@ -1,8 +1,16 @@
+import atexit
+import mmap
 import numpy as np
+import os
+import queue
+import threading
 import time
+import weakref
 from ctypes import (
     POINTER,
-    c_ubyte,
+    byref,
+    c_int,
+    c_size_t,
     c_uint64,
     c_char_p,
     c_void_p,
@@ -10,16 +18,26 @@ from ctypes import (
     c_bool,
     c_int32,
     Structure,
-    addressof,
     cdll
 )
 
+# the pybind11 bindings for the frame-rate calls are optional, see lib/configure.py
+try:
+    import _buffer
+    _HAS_PYBIND = True
+except ImportError:
+    _HAS_PYBIND = False
+
 # return values of _lib.read_frame and _lib.write_frame
 SUCCESS = 0
 FRAME_SIZE_MISMATCH = 1
 BLOCK_NOT_ACTIVE = 2
 NO_NEW_FRAME = 3
 
+# flags of _lib.create_block
+BLOCK_HUGE_PAGES = 1
+BLOCK_PREFAULT = 2
+
 
 class _Frame(Structure):
     _fields_ = [
@@ -28,15 +46,44 @@ class _Frame(Structure):
         ("depth", c_ssize_t),
         ("acquisition_time", c_uint64),
         ("frame_uid", c_uint64),
-        ("data", POINTER(c_ubyte)),
+        ("data", c_void_p),
+    ]
+
+
+class _WriteArgs(Structure):
+    _fields_ = [
+        ("width", c_ssize_t),
+        ("height", c_ssize_t),
+        ("depth", c_ssize_t),
+        ("acquisition_time", c_uint64),
+        ("data", c_void_p),
     ]
 
 
+class _Header(Structure):
+    """Mirrors the leading fields of `buffer_t` in buffer.c. It is laid over the
+    mapped file so new frames can be polled without calling into C."""
+    _fields_ = [
+        ("frame_cnt", c_uint64),
+        ("active_meta", c_uint64),
+        ("width", c_ssize_t),
+        ("height", c_ssize_t),
+        ("depth", c_ssize_t),
+        ("is_alive", c_bool),
+    ]
+
+
+# mirrors `slot_meta_t` in buffer.c, including its trailing padding
+_SLOT_META_DTYPE = np.dtype(
+    [("acq", np.uint64), ("uid", np.uint64), ("slot", np.uint32)], align=True)
+
+
 _lib = cdll.LoadLibrary('libbuffer.so')
 
-# block_t* create_block(const char* direction, size_t width, size_t height, size_t depth);
+# block_t* create_block(const char* direction, size_t width, size_t height,
+#                       size_t depth, int flags);
 _lib.create_block.argtypes = (
-    c_char_p, c_ssize_t, c_ssize_t, c_ssize_t)
+    c_char_p, c_ssize_t, c_ssize_t, c_ssize_t, c_int)
 _lib.create_block.restype = c_void_p
 
 # block_t* open_block(const char* direction);
@@ -78,10 +125,39 @@ _lib.write_frame.argtypes = (
 )
 _lib.write_frame.restype = c_int32
 
-# int read_frame(block_t* block, frame_t* frame);
-_lib.read_frame.argtypes = (c_void_p, c_void_p, c_bool)
+# int write_frame_v2(block_t* block, const write_args_t* args);
+_lib.write_frame_v2.argtypes = (c_void_p, POINTER(_WriteArgs))
+_lib.write_frame_v2.restype = c_int32
+
+# image* acquire_write_slot(block_t* block);
+_lib.acquire_write_slot.argtypes = (c_void_p,)
+_lib.acquire_write_slot.restype = c_void_p
+
+# int publish_write_slot(block_t* block, uint64_t acquisition_time);
+_lib.publish_write_slot.argtypes = (c_void_p, c_uint64)
+_lib.publish_write_slot.restype = c_int32
+
+# int get_ready_fd(block_t* block);
+_lib.get_ready_fd.argtypes = (c_void_p,)
+_lib.get_ready_fd.restype = c_int
+
+# int read_frame(block_t* block, frame_t* frame, bool block_thread);
+_lib.read_frame.argtypes = (c_void_p, POINTER(_Frame), c_bool)
 _lib.read_frame.restype = c_int32
 
+# int read_frame_batch(block_t* block, frame_t* frame, size_t n, image* out,
+#                      uint64_t* acquisition_times, size_t* n_filled, bool block_thread);
+_lib.read_frame_batch.argtypes = (
+    c_void_p,
+    POINTER(_Frame),
+    c_size_t,
+    c_void_p,
+    c_void_p,
+    POINTER(c_size_t),
+    c_bool,
+)
+_lib.read_frame_batch.restype = c_int32
+
 
 # frame_t* create_frame();
 _lib.create_frame.argtypes = None
@@ -95,6 +171,110 @@ _lib.delete_frame.restype = None
 _lib.block_image_size.argtypes = c_void_p,
 _lib.block_image_size.restype = c_ssize_t
 
+# int get_shm_fd(const block_t* block);
+_lib.get_shm_fd.argtypes = c_void_p,
+_lib.get_shm_fd.restype = c_int
+
+# void get_shm_layout(const block_t* block, size_t* meta_offset, size_t* images_offset,
+#                     size_t* slot_size, size_t* n_slots);
+_lib.get_shm_layout.argtypes = (c_void_p, c_void_p, c_void_p, c_void_p, c_void_p)
+_lib.get_shm_layout.restype = None
+
+
+def _map_block(block):
+    """Maps the buffer behind `block` into this process. Returns the mmap, the
+    `_Header` laid over it, a structured array over the frame records, and one
+    (height, width, depth) array view per image slot, or `None` if the writer
+    has not finished setting the buffer up.
+    """
+    meta_offset, images_offset = c_size_t(), c_size_t()
+    slot_size, n_slots = c_size_t(), c_size_t()
+    _lib.get_shm_layout(block, byref(meta_offset), byref(images_offset),
+                        byref(slot_size), byref(n_slots))
+    if n_slots.value == 0:
+        return None
+
+    mm = mmap.mmap(_lib.get_shm_fd(block),
+                   images_offset.value + slot_size.value * n_slots.value)
+    header = _Header.from_buffer(mm)
+    metas = np.frombuffer(mm, dtype=_SLOT_META_DTYPE, count=n_slots.value,
+                          offset=meta_offset.value)
+    shape = (header.height, header.width, header.depth)
+    image_size = header.height * header.width * header.depth
+    # the views are built once per attach rather than per frame. np.frombuffer
+    # keeps `mm` alive for as long as any frame handed to a caller is, which a
+    # view over a raw address would not.
+    views = [np.frombuffer(mm, dtype=np.uint8, count=image_size,
+                           offset=images_offset.value + i * slot_size.value).reshape(shape)
+             for i in range(n_slots.value)]
+    # every reader shares these images, so none of them may draw on one in place
+    for view in views:
+        view.flags.writeable = False
+    return mm, header, metas, views
+
+
+def _make_frame_writer(block, args, args_ref, frame_shape):
+    """Returns a function that writes one frame to `block`. Everything that is
+    fixed for the block's lifetime is bound as a default argument, so the hot
+    path only touches locals.
+    """
+    if _HAS_PYBIND:
+        write = _buffer.Block(block).write_frame
+    else:
+        def write(frame, acq_time, _block=block, _args=args, _args_ref=args_ref,
+                  _write_frame_v2=_lib.write_frame_v2):
+            # capture devices usually reuse their output array, so the data
+            # pointer is only updated when the address actually changes
+            addr = frame.__array_interface__['data'][0]
+            if addr != _args.data:
+                _args.data = addr
+            _args.acquisition_time = acq_time
+            return _write_frame_v2(_block, _args_ref)
+
+    def write_frame(frame, acq_time, _write=write, _frame_shape=frame_shape):
+        if frame.shape != _frame_shape:
+            print(
+                "Error: frame size mismatch. Please ensure input frames are consistent.")
+            return
+
+        if _write(frame, acq_time) == BLOCK_NOT_ACTIVE:
+            print("Block is not active.")
+    return write_frame
+
+
+def _write_worker(pending, write_frame, errors):
+    # deliberately holds no reference to the writer so it can still be collected
+    main_thread = threading.main_thread()
+    while True:
+        try:
+            item = pending.get(timeout=0.1)
+        except queue.Empty:
+            # the worker is not a daemon, so queued frames are never dropped, and
+            # has to notice on its own that the interpreter is shutting down
+            if not main_thread.is_alive():
+                return
+            continue
+        try:
+            if item is None:
+                return
+            write_frame(*item)
+        except Exception as e:
+            # handed back to the caller on its next write_frame
+            errors.append(e)
+        finally:
+            pending.task_done()
+
+
+# writers that still own a block. Finalization may run a writer's __del__ late
+# or not at all, so they are closed explicitly when the interpreter exits.
+_open_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_writers():
+    for writer in list(_open_writers):
+        writer.close()
+
 
 class ExistentialError(Exception):
     pass
@@ -105,16 +285,30 @@ class NoFrameError(Exception):
 
 
 class BufferedFrameWriter:
-    def __init__(self, name: str):
+    def __init__(self, name: str, threaded: bool = False,
+                 huge_pages: bool = False, prefault: bool = False):
         """Creates a frame buffer accessible by `name`
+
+        If `threaded` is True, frames are copied into the buffer by a worker
+        thread so the caller can start acquiring the next frame right away.
+
+        If `huge_pages` is True, the buffer asks for 2 MB transparent huge
+        pages, which cuts TLB misses when copying large frames.
+
+        If `prefault` is True, the whole buffer is populated and locked in
+        memory when it is created, so the first frames are not slowed down by
+        page faults.
         """
         self.name = name
         self._block = None
-
-    def write_frame(self, frame: np.ndarray, acq_time: np.uint64):
-        """Writes `frame` to the frame buffer. `act_time` is the 
-        time in milliseconds when `frame` was acquired.
-        """
+        self._write_args = None
+        self._threaded = threaded
+        self._flags = ((BLOCK_HUGE_PAGES if huge_pages else 0) |
+                       (BLOCK_PREFAULT if prefault else 0))
+        self._pending = None
+        self._worker = None
+
+    def _create_block(self, frame: np.ndarray):
         width = height = depth = 1
         if len(frame.shape) == 1:
             width = frame.shape[0]
@@ -123,32 +317,80 @@ class BufferedFrameWriter:
         else:
             height, width, depth = frame.shape
 
-        if self._block is None:
-            c_name = self.name.encode("utf-8")
+        c_name = self.name.encode("utf-8")
+        self._block = _lib.create_block(
+            c_name, width, height, depth, self._flags)
+        if self._block is None and _lib.cstr_block_is_poisoned(c_name):
+            tmp_block = _lib.open_block(c_name)
+            _lib.destroy_block(tmp_block)
+            time.sleep(1)
             self._block = _lib.create_block(
-                c_name, width, height, depth)
-            if self._block is None and _lib.cstr_block_is_poisoned(c_name):
-                tmp_block = _lib.open_block(c_name)
-                _lib.destroy_block(tmp_block)
-                time.sleep(1)
-                self._block = _lib.create_block(
-                    c_name, width, height, depth)
-            if self._block is None:
-                raise ExistentialError()
-
-        exit_code = _lib.write_frame(
-            self._block, width, height, depth, acq_time, frame.ctypes.data)
-
-        if exit_code == FRAME_SIZE_MISMATCH:
-            print(
-                "Error: frame size mismatch. Please ensure input frames are consistent.")
-        elif exit_code == BLOCK_NOT_ACTIVE:
-            print("Block is not active.")
+                c_name, width, height, depth, self._flags)
+        if self._block is None:
+            raise ExistentialError()
+        _open_writers.add(self)
+        # the dimensions are fixed for the block's lifetime, so the argument
+        # struct is marshalled once and passed by reference on every write
+        self._write_args = _WriteArgs(width, height, depth, 0, None)
+        write_frame = _make_frame_writer(
+            self._block, self._write_args, byref(self._write_args), frame.shape)
+
+        if self._threaded:
+            self._pending = queue.Queue()
+            errors = []
+            self._worker = threading.Thread(
+                target=_write_worker, args=(self._pending, write_frame, errors))
+            self._worker.start()
+
+            def write_frame(frame, acq_time, _errors=errors,
+                            _join=self._pending.join, _put=self._pending.put):
+                # keep at most one copy in flight
+                _join()
+                if _errors:
+                    raise _errors.pop()
+                _put((frame, acq_time))
+
+        # later calls skip the block setup and go straight to the specialised
+        # writer, which shadows this method on the instance
+        self.write_frame = write_frame
 
-    def __del__(self):
+    def write_frame(self, frame: np.ndarray, acq_time: np.uint64):
+        """Writes `frame` to the frame buffer. `act_time` is the 
+        time in milliseconds when `frame` was acquired. `frame` must be
+        C-contiguous.
+
+        In threaded mode this returns once the previous frame has been
+        published, while `frame` itself is still being copied. `frame` must
+        not be modified until the next `write_frame` call returns, so callers
+        that reuse capture buffers should alternate between two of them.
+        """
+        # only reached on the first call. `_create_block` replaces this method
+        # with a writer specialised to the block it creates.
+        self._create_block(frame)
+        self.write_frame(frame, acq_time)
+
+    def close(self):
+        """Publishes any frame still being copied and destroys the buffer.
+        Called automatically when the writer is collected or the interpreter
+        exits. A later `write_frame` creates a new buffer.
+        """
+        # the specialised writer holds the block, so it must not outlive it
+        self.__dict__.pop('write_frame', None)
+        if self._worker is not None:
+            # frames are copied in order, so this runs after the last one
+            self._pending.put(None)
+            self._worker.join()
+            self._worker = None
+        self._pending = None
+        self._write_args = None
         # free memory to prevent memory leaks
         if self._block != None:
             _lib.destroy_block(self._block)
+            self._block = None
+        _open_writers.discard(self)
+
+    def __del__(self):
+        self.close()
 
 
 class BufferedFrameReader:
@@ -157,21 +399,72 @@ class BufferedFrameReader:
         """
         self.name = name
         self._frame = self._setup_accessor_frame()
+        self._frame_ref = byref(self._frame)
+        self._pyblock = None
         self._last_python_frame = None
-        self._array = None
+        self._mm = None
+        self._header = None
+        self._metas = None
+        self._slot_views = None
+        self._shape = None
+        self._ready_fd = None
         self._block = None
         self._attach_to_block()
 
     def _attach_to_block(self, show_found_msg=False):
-        while self._block is None:
-            self._block = _lib.open_block(self.name.encode("utf-8"))
-            if self._block is None:
-                print(f"Block {self.name} dne. Waiting and trying again.")
-                show_found_msg = True
-                time.sleep(3)
+        while not self._try_attach_to_block():
+            print(f"Block {self.name} dne. Waiting and trying again.")
+            show_found_msg = True
+            time.sleep(3)
         if show_found_msg:
             print(f"Found {self.name}!!!")
 
+    def _try_attach_to_block(self):
+        """Opens the buffer once. Returns `False` if it does not exist or the
+        writer has not finished setting it up."""
+        block = _lib.open_block(self.name.encode("utf-8"))
+        if block is None:
+            return False
+        mapped = _map_block(block)
+        if mapped is None:
+            _lib.close_block(block)
+            return False
+        self._block = block
+        self._mm, self._header, self._metas, self._slot_views = mapped
+        if _HAS_PYBIND:
+            self._pyblock = _buffer.Block(self._block)
+        # a block's dimensions never change, and a writer that restarts with new
+        # ones creates a new block that is picked up here, so the shape is only
+        # read once per attach
+        self._shape = self._slot_views[0].shape
+        # frame uids restart whenever a block is recreated
+        self._frame.frame_uid = 0
+        if self._ready_fd is not None:
+            # the previous descriptor was closed along with the previous block
+            self._ready_fd = None
+            self.fileno()
+        return True
+
+    def _detach_from_block(self):
+        print(f"Lost access to {self.name}. Retrying open.")
+        # views that were handed out keep the Python mmap of the old buffer
+        # alive, so they stay valid after the block is closed
+        _lib.close_block(self._block)
+        self._block = None
+
+    def _ensure_attached(self, wait_for_frame):
+        """Reopens the buffer if a call that did not wait lost it. Returns
+        `False` if it is still gone and `wait_for_frame` is False."""
+        if self._block is not None:
+            return True
+        if wait_for_frame:
+            self._attach_to_block(True)
+            return True
+        if self._try_attach_to_block():
+            print(f"Found {self.name}!!!")
+            return True
+        return False
+
     def _setup_accessor_frame(self):
         frame = _Frame()
         frame.frame_uid = np.uint64(0)
@@ -184,30 +477,134 @@ class BufferedFrameReader:
         This function blocks when `wait_for_frame` is True. If `wait_for_frame`
         is set to False, and there is no new frame ready in the buffer, 
         this function returns `None`
+
+        The frame data is a read-only view into the shared buffer, not a copy.
+        With the default of two slots the writer starts overwriting it as soon
+        as it publishes the next frame, so call `.copy()` on it if it needs to
+        outlive that or has to be modified.
+
+        New frames are picked up by polling the mapped header, so a frame
+        published while the caller was busy is returned without blocking. Only
+        when there is nothing new does this wait inside `read_frame`, which
+        never calls back into Python, so ctypes releases the GIL for the
+        duration of the wait and other threads keep running.
+
+        If the writer goes away, this waits for it to come back when
+        `wait_for_frame` is True. Otherwise it returns `None`, and later calls
+        try to reopen the buffer without waiting.
         """
+        if not self._ensure_attached(wait_for_frame):
+            return None
         curr_frame = self._frame
-
-        exit_code = _lib.read_frame(
-            self._block, addressof(curr_frame), wait_for_frame)
+        header = self._header
+
+        if self._ready_fd is not None and header.is_alive:
+            # reset the descriptor before looking at the header, so a frame
+            # published around the reset is either returned below or leaves it
+            # readable, and a readable descriptor means a frame is unread
+            self._drain_ready_fd()
+
+        if not header.is_alive:
+            exit_code = BLOCK_NOT_ACTIVE
+        elif header.frame_cnt != curr_frame.frame_uid:
+            exit_code = SUCCESS
+        elif wait_for_frame:
+            # only block in C when there is nothing new to pick up
+            if self._pyblock is not None:
+                exit_code = self._pyblock.read_frame(curr_frame.frame_uid, True)[0]
+            else:
+                exit_code = _lib.read_frame(self._block, self._frame_ref, True)
+        else:
+            exit_code = NO_NEW_FRAME
 
         if exit_code == BLOCK_NOT_ACTIVE:
-            print(f"Lost access to {self.name}. Retrying open.")
-            self._block = None
-            self._attach_to_block(True)
-            return self.get_next_frame()
-        elif exit_code == FRAME_SIZE_MISMATCH:
-            pass  # never be here.
+            # waiting for the writer here would stall every other buffer a
+            # caller that does not wait is multiplexing
+            self._detach_from_block()
+            return self.get_next_frame(wait_for_frame)
         elif exit_code == NO_NEW_FRAME:
             return None
-        shape = (curr_frame.height, curr_frame.width, curr_frame.depth)
 
-        if (self._array is None or
-                self._array.__array_interface__['data'][0] != addressof(curr_frame.data.contents)):
-            self._array = np.ctypeslib.as_array(curr_frame.data, shape)
+        # the writer fills a record before making it active, so the record read
+        # here is consistent unless the writer laps this reader.
+        acq_time, frame_uid, slot = self._metas.item(header.active_meta)
+        curr_frame.frame_uid = frame_uid
 
-        self._last_python_frame = self._array, curr_frame.acquisition_time
+        self._last_python_frame = self._slot_views[slot], acq_time
         return self._last_python_frame
 
+    def get_frames(self, n: int, wait_for_frame=True):
+        """ Returns a pair. The first value is an array of up to `n` new frames
+        stacked along the first axis. The second value is a list of the times
+        those frames were acquired, as ints like in `get_next_frame()`.
+
+        All frames are copied out of the buffer in a single call into the C
+        library, which suits consumers that process frames in batches. Like
+        `get_next_frame()`, each read picks up the newest frame, so frames
+        published while a copy is in progress are skipped and the batch is a
+        newest-frame subsequence of the stream. This blocks until `n` frames
+        are read when `wait_for_frame` is True. Otherwise it returns the frames
+        that are ready, which may be none. A writer that goes away is handled
+        as in `get_next_frame()`.
+        """
+        if not self._ensure_attached(wait_for_frame):
+            return np.empty((0,) + self._shape, dtype=np.uint8), []
+        if self._ready_fd is not None:
+            # frames published after this are not read by this call, so they
+            # leave the descriptor readable
+            self._drain_ready_fd()
+
+        frames = np.empty((n,) + self._shape, dtype=np.uint8)
+        acq_times = np.empty(n, dtype=np.uint64)
+        n_filled = c_size_t()
+
+        exit_code = _lib.read_frame_batch(
+            self._block, self._frame_ref, n, frames.ctypes.data,
+            acq_times.ctypes.data, byref(n_filled), wait_for_frame)
+
+        if exit_code == BLOCK_NOT_ACTIVE:
+            self._detach_from_block()
+            if n_filled.value == 0:
+                return self.get_frames(n, wait_for_frame)
+
+        filled = n_filled.value
+        times = acq_times[:filled].tolist()
+        if filled:
+            self._last_python_frame = frames[filled - 1], times[-1]
+        return frames[:filled], times
+
+    def _drain_ready_fd(self):
+        try:
+            os.read(self._ready_fd, 8)
+        except BlockingIOError:
+            pass
+
+    def fileno(self):
+        """Returns a file descriptor that becomes readable when a new frame is
+        published, so readers can be passed to `select()`, `selectors` or
+        `asyncio`'s `add_reader()` and wait on several buffers at once.
+        `get_next_frame()` and `get_frames()` reset it, so call one of them with
+        `wait_for_frame=False` once the descriptor is readable.
+
+        The descriptor is created on the first call and is fed by a helper
+        thread in this process. It also becomes readable when the writer goes
+        away. The `get_next_frame()` or `get_frames()` call that notices this
+        closes it, and once the reader reattaches to a restarted writer
+        `fileno()` returns a new descriptor. Unregister the old one, keep
+        polling with `wait_for_frame=False` until the reader reattaches, and
+        then register `fileno()` again. Like a closed file, this raises
+        `ValueError` while the buffer is gone, which `selectors` handles when
+        unregistering the reader.
+        """
+        if not self._ensure_attached(False):
+            raise ValueError(f"Block {self.name} is not available")
+        if self._ready_fd is None:
+            ready_fd = _lib.get_ready_fd(self._block)
+            if ready_fd == -1:
+                raise OSError(f"Failed to create a ready descriptor for {self.name}")
+            self._ready_fd = ready_fd
+        return self._ready_fd
+
     def has_last_frame(self):
         """Returns `True` if `get_next_frame()` successfully terminated once."""
         return self._last_python_frame is not None
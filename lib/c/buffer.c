@@ -10,6 +10,7 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/eventfd.h>
 #include <sys/mman.h>
 #include <unistd.h>
 
@@ -18,26 +19,44 @@
        __typeof__ (b) _b = (b); \
      _a > _b ? _a : _b; })
 
-typedef struct frame_metadata {
-    uint64_t frame_uid;
+// images start on a cache line, or on a huge page when BLOCK_HUGE_PAGES is set
+#define SLOT_ALIGNMENT 64ul
+#define HUGE_PAGE_SIZE (2ul << 20)
+
+// metadata of a published frame. The records are packed into their own array,
+// away from the images, so scanning them only touches a cache line or two.
+typedef struct slot_meta {
     uint64_t acquisition_time;
-    pthread_rwlock_t rwlock;
-} frame_metadata_t;
+    uint64_t frame_uid;
+    uint32_t slot_idx;  // image slot holding the frame
+} slot_meta_t;
 
 typedef struct buffer {
+    // the fields up to and including [is_alive] are read directly from the mapped
+    // file by accessor.py (see _Header). Keep the two layouts in sync.
     uint64_t frame_cnt;  // ideally our modules never run long enough to overflow this count
+    uint64_t active_meta;  // index of the most recently published record in metas
     size_t width, height, depth;
     bool is_alive;
     pid_t owner;
     pthread_cond_t cond;
     pthread_mutex_t cond_mutex;
-    frame_metadata_t metadata[BUFFER_COUNT];
-    image images[];
+    size_t n_slots;  // number of images, and of slot_meta_t records
+    size_t meta_offset;  // the slot_meta_t records start here
+    size_t images_offset;  // images are stored [slot_size] bytes apart from here
+    size_t slot_size;
 } buffer_t;
 
 typedef struct block {
     char* filename;
+    int fd;
     buffer_t* buffer;
+    // bytes mapped at [buffer]
+    size_t size;
+    // eventfd signalled by [notifier] for every new frame, -1 until requested
+    int ready_fd;
+    pthread_t notifier;
+    bool stop_notifier;
 } block_t;
 
 // helper functions to grab size in bytes for a particular data structure
@@ -47,67 +66,110 @@ size_t buffer_image_size(const buffer_t* b) {
 size_t frame_image_size(const frame_t* f) {
     return f->width * f->height * f->depth;
 }
-size_t buffer_size(size_t weight, size_t height, size_t depth) {
-    return sizeof(buffer_t) + (weight * height * depth * BUFFER_COUNT);
+size_t buffer_size(const buffer_t* b) {
+    return b->images_offset + b->slot_size * b->n_slots;
+}
+size_t round_up(size_t n, size_t alignment) {
+    return (n + alignment - 1) / alignment * alignment;
+}
+image* buffer_slot(buffer_t* b, uint64_t slot) {
+    return (image*)b + b->images_offset + b->slot_size * slot;
+}
+slot_meta_t* buffer_metas(buffer_t* b) {
+    return (slot_meta_t*)((image*)b + b->meta_offset);
 }
 size_t block_image_size(const block_t* b) {
     return buffer_image_size(b->buffer);
 }
 
-int write_frame(block_t* block, size_t width, size_t height, size_t depth,
-                uint64_t acquisition_time, image* data) {
-    buffer_t* buffer = block->buffer;
+int get_shm_fd(const block_t* block) {
+    return block->fd;
+}
 
-    // assert precondition: frame size is homogenous
-    if (buffer->width != width ||
-        buffer->height != height ||
-        buffer->depth != depth) {
-        return FRAME_SIZE_MISMATCH;
-    }
+void get_shm_layout(const block_t* block, size_t* meta_offset, size_t* images_offset,
+                    size_t* slot_size, size_t* n_slots) {
+    // published last by the owner, so the rest of the layout is valid once it is set
+    *n_slots = __atomic_load_n(&block->buffer->n_slots, __ATOMIC_ACQUIRE);
+    *meta_offset = block->buffer->meta_offset;
+    *images_offset = block->buffer->images_offset;
+    *slot_size = block->buffer->slot_size;
+}
+
+// index of the slot that is not currently published. Only the owner writes to it.
+static uint32_t inactive_slot(const buffer_t* buffer) {
+    return (buffer->frame_cnt + 1) % buffer->n_slots;
+}
+
+image* acquire_write_slot(block_t* block) {
+    buffer_t* buffer = block->buffer;
 
     // assert precondition: block is active
-    if (!buffer->is_alive) return BLOCK_NOT_ACTIVE;
+    if (!buffer->is_alive) return NULL;
 
-    uint32_t buffer_to_write_to = (buffer->frame_cnt + 1) % BUFFER_COUNT;
-    frame_metadata_t* metadata = &buffer->metadata[buffer_to_write_to];
+    return buffer_slot(buffer, inactive_slot(buffer));
+}
 
-    // grab write lock
-    pthread_rwlock_wrlock(&metadata->rwlock);
+int publish_write_slot(block_t* block, uint64_t acquisition_time) {
+    buffer_t* buffer = block->buffer;
 
-    // write the image and corresponding metadata
-    size_t image_size = buffer_image_size(buffer);
-    memcpy(&buffer->images[image_size * buffer_to_write_to],
-           data, image_size * sizeof(unsigned char));
-    buffer->frame_cnt += 1;
-    metadata->acquisition_time = acquisition_time;
-    metadata->frame_uid = buffer->frame_cnt;
+    // assert precondition: block is active
+    if (!buffer->is_alive) return BLOCK_NOT_ACTIVE;
 
-    // release write lock
-    pthread_rwlock_unlock(&metadata->rwlock);
+    // neither the slot nor its record are visible to readers yet, so the
+    // record can be written freely
+    uint64_t frame_uid = buffer->frame_cnt + 1;
+    uint32_t meta_idx = frame_uid % buffer->n_slots;
+    slot_meta_t* meta = &buffer_metas(buffer)[meta_idx];
+    meta->acquisition_time = acquisition_time;
+    meta->frame_uid = frame_uid;
+    meta->slot_idx = inactive_slot(buffer);
 
-    // notify all watchers that a new image has been posted
+    // swap the active slot and notify all watchers that a new image has been posted.
     // we take care to avoid the following scenario: read thread sees that
     //      no frame is available -> broadcast -> read thread sleeps -> misses out on frame
     pthread_mutex_lock(&buffer->cond_mutex);
+    __atomic_store_n(&buffer->active_meta, meta_idx, __ATOMIC_RELEASE);
+    __atomic_store_n(&buffer->frame_cnt, frame_uid, __ATOMIC_RELEASE);
     pthread_cond_broadcast(&buffer->cond);
     pthread_mutex_unlock(&buffer->cond_mutex);
 
+    // the next write goes into the slot that was active until now. Make sure
+    // readers see the new frame_cnt before any of those writes
+    __atomic_thread_fence(__ATOMIC_SEQ_CST);
+
     return SUCCESS;
 }
 
+int write_frame(block_t* block, size_t width, size_t height, size_t depth,
+                uint64_t acquisition_time, image* data) {
+    buffer_t* buffer = block->buffer;
+
+    // assert precondition: frame size is homogenous
+    if (buffer->width != width ||
+        buffer->height != height ||
+        buffer->depth != depth) {
+        return FRAME_SIZE_MISMATCH;
+    }
+
+    image* slot = acquire_write_slot(block);
+    if (slot == NULL) return BLOCK_NOT_ACTIVE;
+
+    memcpy(slot, data, buffer_image_size(buffer) * sizeof(unsigned char));
+    return publish_write_slot(block, acquisition_time);
+}
+
+int write_frame_v2(block_t* block, const write_args_t* args) {
+    return write_frame(block, args->width, args->height, args->depth,
+                       args->acquisition_time, args->data);
+}
+
 int read_frame(block_t* block, frame_t* frame, bool block_thread) {
     // this needs to be inside because of the case:
     // read sees buffer is alive -> buffer is not alive -> broadcast give up->
     // read thread sleeps -> forever asleep.
-
     pthread_mutex_lock(&block->buffer->cond_mutex);
-    // figure out which frame needs to be grabbed
     buffer_t* buffer = block->buffer;
 
-    // realloc frame data outside of locking any threads so code does not
-    // block for longer than it needs to
-    frame->data = (unsigned char*)realloc(frame->data,
-                                          buffer_image_size(buffer));
     frame->width = buffer->width;
     frame->height = buffer->height;
     frame->depth = buffer->depth;
@@ -118,68 +180,64 @@ int read_frame(block_t* block, frame_t* frame, bool block_thread) {
         return BLOCK_NOT_ACTIVE;
     }
 
-    uint64_t newest_buffer = buffer->frame_cnt;
-    uint64_t last_buffer = frame->frame_uid;
-
-    uint64_t target_frame_uid;
-    if (newest_buffer < BUFFER_COUNT)
-        target_frame_uid = last_buffer + 1;
-    else
-        target_frame_uid = max(
-            last_buffer + 1,
-            newest_buffer - BUFFER_COUNT + 1);
-
-    // this is within the range of an integer.
-    int target_buffer = target_frame_uid % BUFFER_COUNT;
-
-    // try to accquire read lock, if it isn't available,
-    // register self as watcher
-    frame_metadata_t* metadata = &(buffer->metadata[target_buffer]);
-
-    if (last_buffer == newest_buffer) {
-        if (block_thread) {
-            // if the newest frame is not yet available
-            pthread_cond_wait(&buffer->cond, &buffer->cond_mutex);
-            if (!buffer->is_alive) {
-                pthread_mutex_unlock(&buffer->cond_mutex);
-                return BLOCK_NOT_ACTIVE;
-            }
-        } else {
+    // wait until a frame other than the one held in [frame] is published
+    while (buffer->frame_cnt == frame->frame_uid) {
+        if (!block_thread) {
             pthread_mutex_unlock(&buffer->cond_mutex);
             return NO_NEW_FRAME;
         }
-    }
-    // try to acquire read lock, if that fails, then we are busy
-    while (pthread_rwlock_tryrdlock(&metadata->rwlock) != 0) {
         pthread_cond_wait(&buffer->cond, &buffer->cond_mutex);
         if (!buffer->is_alive) {
             pthread_mutex_unlock(&buffer->cond_mutex);
             return BLOCK_NOT_ACTIVE;
         }
-    }  // we have acquired permissions at this point.
-    // if the framework is dead, then cleanly exit
+    }
+
+    // peek at the published slot. The writer only touches the inactive slot, so
+    // no copy is needed
+    uint64_t meta_idx = __atomic_load_n(&buffer->active_meta, __ATOMIC_ACQUIRE);
+    slot_meta_t* meta = &buffer_metas(buffer)[meta_idx];
+    frame->frame_uid = meta->frame_uid;
+    frame->acquisition_time = meta->acquisition_time;
+    frame->data = buffer_slot(buffer, meta->slot_idx);
 
     pthread_mutex_unlock(&buffer->cond_mutex);
+    return SUCCESS;
+}
 
-    // read from the frame
-    size_t image_size = frame_image_size(frame);
-    frame->frame_uid = metadata->frame_uid;
-    frame->acquisition_time = metadata->acquisition_time;
-    memcpy(frame->data, &buffer->images[image_size * target_buffer], image_size * sizeof(unsigned char));
+int read_frame_batch(block_t* block, frame_t* frame, size_t n, image* out,
+                     uint64_t* acquisition_times, size_t* n_filled, bool block_thread) {
+    size_t image_size = buffer_image_size(block->buffer);
+    int exit_code = SUCCESS;
+    *n_filled = 0;
 
-    pthread_rwlock_unlock(&metadata->rwlock);
-    return SUCCESS;
+    while (*n_filled < n) {
+        exit_code = read_frame(block, frame, block_thread);
+        if (exit_code != SUCCESS) break;
+
+        memcpy(&out[image_size * *n_filled], frame->data, image_size * sizeof(unsigned char));
+
+        // the copy may be torn if the owner moved on to overwriting this slot
+        // in the meantime. In that case drop it and copy the newest frame instead.
+        __atomic_thread_fence(__ATOMIC_ACQUIRE);
+        if (__atomic_load_n(&block->buffer->frame_cnt, __ATOMIC_RELAXED) != frame->frame_uid)
+            continue;
+
+        acquisition_times[*n_filled] = frame->acquisition_time;
+        *n_filled += 1;
+    }
+    return exit_code;
 }
 
 frame_t* create_frame() {
     frame_t* frame = (frame_t*)malloc(sizeof(frame_t));
-    frame->data = (unsigned char*)malloc(sizeof(unsigned char) * 8);
+    frame->data = NULL;
     frame->frame_uid = 0ull;
     return frame;
 }
 
 void delete_frame(frame_t* ptr) {
-    free(ptr->data);
+    // [ptr->data] points into the buffer and is not owned by the frame
     free(ptr);
 }
 
@@ -199,14 +257,75 @@ char* file_address_from_direction(const char* direction) {
 }
 
 // this is a helper
-block_t* new_block(char* filename, buffer_t* buffer) {
+block_t* new_block(char* filename, int fd, buffer_t* buffer, size_t size) {
     block_t* new_block = (block_t*)malloc(sizeof(block_t));
     new_block->buffer = buffer;
+    new_block->size = size;
+    new_block->fd = fd;
     new_block->filename = filename;
+    new_block->ready_fd = -1;
+    new_block->stop_notifier = false;
     return new_block;
 }
 
-block_t* create_block(const char* direction, size_t width, size_t height, size_t depth) {
+// forwards frame publications of [arg]'s buffer to its ready_fd. The eventfd lives in
+// this process, so it is fed from the process-shared condition variable instead
+// of by the owner.
+static void* notify_ready(void* arg) {
+    block_t* block = (block_t*)arg;
+    buffer_t* buffer = block->buffer;
+    uint64_t one = 1;
+
+    pthread_mutex_lock(&buffer->cond_mutex);
+    uint64_t last_seen = buffer->frame_cnt;
+    while (!block->stop_notifier) {
+        if (!buffer->is_alive || buffer->frame_cnt != last_seen) {
+            last_seen = buffer->frame_cnt;
+            // also signal a dead block, so readers wake up and notice
+            if (write(block->ready_fd, &one, sizeof(one)) == -1 && errno != EAGAIN) break;
+            if (!buffer->is_alive) break;
+        }
+        pthread_cond_wait(&buffer->cond, &buffer->cond_mutex);
+    }
+    pthread_mutex_unlock(&buffer->cond_mutex);
+    return NULL;
+}
+
+int get_ready_fd(block_t* block) {
+    if (block->ready_fd != -1) return block->ready_fd;
+
+    int ready_fd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    if (ready_fd == -1) {
+        fprintf(stderr, "Failed to create an eventfd for %s: %s.", block->filename,
+                strerror(errno));
+        return -1;
+    }
+    block->ready_fd = ready_fd;
+    if (pthread_create(&block->notifier, NULL, notify_ready, block) != 0) {
+        fprintf(stderr, "Failed to start the frame notifier for %s.", block->filename);
+        close(ready_fd);
+        block->ready_fd = -1;
+    }
+    return block->ready_fd;
+}
+
+// stops the thread started by [get_ready_fd], if any, and closes the eventfd
+static void stop_ready_fd(block_t* block) {
+    if (block->ready_fd == -1) return;
+
+    // the other waiters on the shared condition variable treat this as a spurious wakeup
+    pthread_mutex_lock(&block->buffer->cond_mutex);
+    block->stop_notifier = true;
+    pthread_cond_broadcast(&block->buffer->cond);
+    pthread_mutex_unlock(&block->buffer->cond_mutex);
+
+    pthread_join(block->notifier, NULL);
+    close(block->ready_fd);
+    block->ready_fd = -1;
+}
+
+block_t* create_block(const char* direction, size_t width, size_t height, size_t depth,
+                      int flags) {
     char* file_address = file_address_from_direction(direction);
     if (file_address == NULL) return NULL;
 
@@ -223,7 +342,12 @@ block_t* create_block(const char* direction, size_t width, size_t height, size_t
     // file is open for read and write
     // file owner has read, write, and execute permissions.
     int buffer_file = open(file_address, O_RDWR | O_CREAT, S_IRWXU);
-    size_t bytes_needed = buffer_size(width, height, depth);
+    size_t alignment = flags & BLOCK_HUGE_PAGES ? HUGE_PAGE_SIZE : SLOT_ALIGNMENT;
+    size_t meta_offset = round_up(sizeof(buffer_t), SLOT_ALIGNMENT);
+    size_t images_offset = round_up(meta_offset + sizeof(slot_meta_t) * BUFFER_COUNT,
+                                    alignment);
+    size_t slot_size = round_up(width * height * depth, alignment);
+    size_t bytes_needed = images_offset + slot_size * BUFFER_COUNT;
     if (buffer_file == -1) {
         fprintf(stderr, "Failed to open file \"%s\" with error: %s.", file_address, strerror(errno));
         return NULL;
@@ -236,8 +360,19 @@ block_t* create_block(const char* direction, size_t width, size_t height, size_t
     buffer_t* buffer = (buffer_t*)mmap(NULL, bytes_needed, PROT_READ | PROT_WRITE, MAP_SHARED,
                                        buffer_file, 0);
 
+    // /dev/shm is a tmpfs, which MAP_HUGETLB does not apply to. Ask for
+    // transparent huge pages instead, which tmpfs honours when
+    // /sys/kernel/mm/transparent_hugepage/shmem_enabled is "advise" or "always".
+    if (flags & BLOCK_HUGE_PAGES && madvise(buffer, bytes_needed, MADV_HUGEPAGE) == -1) {
+        fprintf(stderr, "Failed to enable huge pages for \"%s\": %s.", file_address,
+                strerror(errno));
+    }
+
     buffer->frame_cnt = 0ull;
-    close(buffer_file);
+    buffer->active_meta = 0ull;
+    buffer->meta_offset = meta_offset;
+    buffer->images_offset = images_offset;
+    buffer->slot_size = slot_size;
     buffer->width = width;
     buffer->height = height;
     buffer->depth = depth;
@@ -254,13 +389,22 @@ block_t* create_block(const char* direction, size_t width, size_t height, size_t
     pthread_mutexattr_setpshared(&attrmutex, PTHREAD_PROCESS_SHARED);
     pthread_mutex_init(&buffer->cond_mutex, &attrmutex);
 
-    pthread_rwlockattr_t attrrwlock;
-    pthread_rwlockattr_init(&attrrwlock);
-    pthread_rwlockattr_setpshared(&attrrwlock, PTHREAD_PROCESS_SHARED);
-    for (int i = 0; i < BUFFER_COUNT; i++)
-        pthread_rwlock_init(&buffer->metadata[i].rwlock, &attrrwlock);
+    // readers treat a buffer without slots as not set up yet
+    __atomic_store_n(&buffer->n_slots, BUFFER_COUNT, __ATOMIC_RELEASE);
+
+    // touch every page now rather than on the first writes. The header is already
+    // live, so only the records and images are cleared. mlock keeps the pages
+    // resident but is limited by RLIMIT_MEMLOCK, so the buffer is usable either way
+    if (flags & BLOCK_PREFAULT) {
+        memset((char*)buffer + meta_offset, 0, bytes_needed - meta_offset);
+        if (mlock(buffer, bytes_needed) == -1) {
+            fprintf(stderr, "Failed to lock \"%s\" in memory: %s.", file_address,
+                    strerror(errno));
+        }
+    }
 
-    return new_block(file_address, buffer);
+    // the descriptor is kept open so clients can map the buffer themselves
+    return new_block(file_address, buffer_file, buffer, bytes_needed);
 }
 
 block_t* open_block(const char* direction) {
@@ -280,11 +424,18 @@ block_t* open_block(const char* direction) {
         return NULL;
     }
 
+    // the owner may not have sized the file yet
     size_t bytes_needed = lseek(buffer_file, 0, SEEK_END);
+    if (bytes_needed < sizeof(buffer_t)) {
+        fprintf(stderr, "Buffer at \"%s\" is not set up yet.", file_address);
+        close(buffer_file);
+        free(file_address);
+        return NULL;
+    }
     buffer_t* buffer = (buffer_t*)mmap(NULL, bytes_needed, PROT_READ | PROT_WRITE, MAP_SHARED,
                                        buffer_file, 0);
 
-    return new_block(file_address, buffer);
+    return new_block(file_address, buffer_file, buffer, bytes_needed);
 }
 
 bool cstr_block_is_poisoned(const char* direction) {
@@ -325,6 +476,9 @@ please call \"destroy_block\" instead.",
                 getpid(), block->filename);
         return;
     }
+    stop_ready_fd(block);
+    munmap(buffer, block->size);
+    close(block->fd);
     free(block->filename);
     free(block);
 }
@@ -368,11 +522,12 @@ void destroy_block(block_t* block) {
 
     pthread_cond_broadcast(&buffer->cond);
     pthread_mutex_unlock(&buffer->cond_mutex);
+    stop_ready_fd(block);
 
     // sleep for 1 second to allow all watcher threads to clean up
-    munmap(buffer, buffer_size(buffer->width, buffer->height,
-                               buffer->depth));
+    munmap(buffer, block->size);
     remove(new_filename);  // buffer does not exist after this
+    close(block->fd);
     free(new_filename);
     free(block->filename);
     free(block);
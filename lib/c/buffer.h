@@ -17,9 +17,11 @@ extern "C" {
  *
  *      2. buffer_t: Refers to the frame buffer. Contains raw image data and
  *          metadata. It maintains a “master” mutex that all read/write processes
- *          need to interact with. For each frame, it also maintains a frame mutex
- *          which is a pthread rwlock t. This way, the resource allows for multiple
- *          readers at the same time when the data is not being written to.
+ *          need to interact with. Images are held in a fixed ring of slots, two by
+ *          default: the owner writes into the next slot and publishes it by
+ *          atomically swapping the active slot index. Readers peek at the active
+ *          slot in place, so any number of readers can share a frame without
+ *          copying it out of the buffer.
  *          Buffers are unique. There can only be one buffer of the same name
  *          located at /dev/shm/. Buffers have only 1 owner. Only the owner has
  *          write access. All other processes only have read capabilities. This is
@@ -31,7 +33,7 @@ extern "C" {
  *          modern-day solid state storage.
  *
  *      3. frame_t: represents a single frame. Contains image dimensions, acquisition time,
- *          and raw image data. (exposed to client)
+ *          and a pointer to the raw image data inside the buffer. (exposed to client)
  *
  * learn about mutexes here
  *      - http://www.cs.kent.edu/~ruttan/sysprog/lectures/multi-thread/pthread_cond_init.html
@@ -43,8 +45,17 @@ extern "C" {
 #include <stdint.h>
 #include <sys/types.h>
 
-// The number of images held in a buffer.
-#define BUFFER_COUNT 3
+// The number of image slots held in a buffer created by this build. One is published,
+// one is being written, and any others keep older frames intact for slow readers.
+// All slots are allocated by [create_block], and nothing is allocated per frame
+// after that. The owner cycles through the slots in order, which makes acquiring and
+// releasing one O(1) with no bookkeeping. The count is stored in each buffer, so
+// readers built with a different value can still open it.
+//
+// Can be overridden at build time, e.g. -DBUFFER_COUNT=4.
+#ifndef BUFFER_COUNT
+#define BUFFER_COUNT 2
+#endif
 
 // where to store the buffer
 #define BLOCK_DIR "/dev/shm/buffer-"
@@ -56,6 +67,14 @@ typedef unsigned char image;
 typedef struct buffer buffer_t;
 typedef struct block block_t;
 
+// Arguments of [write_frame_v2]. Wrappers can build this once and only update
+// [acquisition_time] and [data] per frame.
+typedef struct write_args {
+    size_t width, height, depth;
+    uint64_t acquisition_time;
+    image* data;
+} write_args_t;
+
 typedef struct frame {
     size_t width, height, depth;
     uint64_t acquisition_time;
@@ -73,20 +92,30 @@ typedef struct frame {
  * ############################################################################
  */
 
+// flags accepted by [create_block]
+//  - BLOCK_HUGE_PAGES: back the images with 2 MB transparent huge pages. Each image
+//      slot is rounded up to a multiple of 2 MB.
+//  - BLOCK_PREFAULT: populate and mlock the whole buffer up front, so the first
+//      frames do not stall on page faults.
+#define BLOCK_HUGE_PAGES 1
+#define BLOCK_PREFAULT 2
+
 // Allocates a new [block_t] struct with name [direction] backed by a mmap [buffer_t]
 // located at [BLOCK_DIR]-[direction]. Memory is allocated for this buffer and the
 // caller of this function will be set as the owner`. The buffer will hold
-// [BUFFER_COUNT] images, each of size [width] * [height] * [depth] bytes.
+// [BUFFER_COUNT] images, each of size [width] * [height] * [depth] bytes. [flags]
+// is a bitwise or of the BLOCK_* flags above.
 //
 // Preconditions:
 //  - [direction] cannot have a "/" character and there must not be an existing block
 //      located at [BLOCK_DIR]-[direction]
 //
 //  usage:
-//      block_t* forward = create_block("forward");
+//      block_t* forward = create_block("forward", 640, 480, 3, 0);
 //      <...omitted...>
 //      destroy_block(forward):
-block_t* create_block(const char* direction, size_t width, size_t height, size_t depth);
+block_t* create_block(const char* direction, size_t width, size_t height, size_t depth,
+                      int flags);
 
 // Allocates a new [block_t] struct with name [direction] that points to an already exsting
 // mmap backed buffer_t located at [BLOCK_DIR]-[direciton]. This function is non-blocking.
@@ -105,6 +134,27 @@ block_t* open_block(const char* direction);
 // Returns the size in bytes required to hold a singular image in block_t [b]
 size_t block_image_size(const block_t* b);
 
+// Returns an eventfd that becomes readable whenever a new frame is published to
+// [block], or when the block stops being active, so readers can select()/poll()
+// across several blocks or integrate with an event loop. Reading it resets it.
+// The descriptor is created on the first call, along with a thread that waits for
+// new frames on behalf of this process, and is owned by [block]: it is closed by
+// [close_block] / [destroy_block]. Returns -1 on failure.
+int get_ready_fd(block_t* block);
+
+// Returns the file descriptor backing [block]'s buffer. Clients may mmap it to
+// access frames without going through this library. The descriptor is owned by
+// [block] and is closed by [close_block] / [destroy_block].
+int get_shm_fd(const block_t* block);
+
+// Describes the layout of the file returned by [get_shm_fd]: a header, followed by
+// [n_slots] packed frame records {uint64_t acquisition_time; uint64_t frame_uid;
+// uint32_t slot_idx;} at [meta_offset], followed by [n_slots] images starting at
+// [images_offset] and placed [slot_size] bytes apart. [slot_size] may be larger than
+// [block_image_size] to keep images aligned.
+void get_shm_layout(const block_t* block, size_t* meta_offset, size_t* images_offset,
+                    size_t* slot_size, size_t* n_slots);
+
 // Returns true if the block whose buffer is backed at [BLOCK_DIR]-[direction]
 // is poisoned.
 //
@@ -132,8 +182,8 @@ bool block_is_alive(const block_t* block);
 // this function will do nothing.
 void destroy_block(block_t* block);
 
-// Frees memory associated with [block]. DOES NOT FREE UNDERLYING BUFFER.
-// Requires that [block] does not own the buffer (destroy block should be used
+// Frees memory associated with [block] and unmaps its view of the buffer. DOES NOT
+// FREE UNDERLYING BUFFER. Requires that [block] does not own the buffer (destroy block should be used
 // instead).
 //
 // Preconditions:
@@ -158,21 +208,48 @@ void close_block(block_t* block);
 #define BLOCK_NOT_ACTIVE 2
 #define NO_NEW_FRAME 3
 
-// Writes the image data in [frame] to [buffer]
+// Returns a pointer to the inactive image slot of [block] so the owner can fill it
+// in place. The slot holds [block_image_size] bytes and is not visible to readers
+// until [publish_write_slot] is called. Returns NULL if the block is not active.
+image* acquire_write_slot(block_t* block);
+
+// Publishes the slot returned by [acquire_write_slot] as the newest frame, stamped
+// with [acquisition_time], and wakes up all waiting readers.
+int publish_write_slot(block_t* block, uint64_t acquisition_time);
+
+// Writes the image data in [frame] to [buffer]. Equivalent to copying [data] into
+// [acquire_write_slot] followed by [publish_write_slot].
 int write_frame(block_t* block, size_t width, size_t height,
                 size_t depth, uint64_t acquisition_time, image* data);
 
-// Reads the earliest frame in [buffer] that is newer than the image held in [frame].
+// Same as [write_frame], with the arguments packed into [args].
+int write_frame_v2(block_t* block, const write_args_t* args);
+
+// Points [frame] at the newest published frame in [buffer] if it is not the frame
+// already held in [frame]. No image data is copied: [frame->data] points into the
+// buffer. The owner may start overwriting it once it has published
+// BUFFER_COUNT - 1 more frames.
 // [read_frame] will wait for a new frame if [block_thread] is true. Else,
 // it terminates with exit code [NO_NEW_FRAME], and [frame] is unchanged.
 int read_frame(block_t* block, frame_t* frame, bool block_thread);
 
+// Copies up to [n] new frames into [out], which must hold [n] images of
+// [block_image_size] bytes, and their acquisition times into [acquisition_times].
+// [frame] tracks the newest frame read so far, as in [read_frame]. Each read picks
+// up the newest frame, so frames the owner publishes while a copy is in progress
+// are skipped and consumers see a newest-frame subsequence of the stream. [n_filled] is set to the number of frames copied.
+// With [block_thread], this waits until all [n] frames are copied. Without it,
+// this stops with [NO_NEW_FRAME] once there are no new frames. In both cases
+// [BLOCK_NOT_ACTIVE] is returned if the block dies partway through.
+int read_frame_batch(block_t* block, frame_t* frame, size_t n, image* out,
+                     uint64_t* acquisition_times, size_t* n_filled, bool block_thread);
+
 // Creates an empty frame struct in a way such that all images are newer than
 // than the image held in the struct and returns a pointer to it.
 frame_t* create_frame();
 
 // given [ptr] for frame_t, this function safely frees the memory
-// and deletes [ptr]
+// and deletes [ptr]. The image data is owned by the buffer and is left untouched.
 void delete_frame(frame_t* ptr);
 
 #ifdef __cplusplus
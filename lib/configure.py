@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 import sys
+import sysconfig
 from ninja_syntax import Writer
 
+# the pybind11 bindings are optional, accessor.py falls back to ctypes without them
+try:
+    import pybind11
+except ImportError:
+    pybind11 = None
+
 outfile = sys.argv[1]
 builddir = f"{outfile.replace('build.ninja', 'binaries')}"
 
@@ -12,3 +19,12 @@ ninja.variable('builddir', builddir)
 ninja.build('$builddir/buffer.o', 'cc', 'lib/c/buffer.c')
 ninja.build('$builddir/libbuffer.so', 'cc-shared',
             '$builddir/buffer.o', implicit=['$builddir/buffer.o'])
+
+if pybind11 is not None:
+    includes = f"-I{sysconfig.get_paths()['include']} -I{pybind11.get_include()}"
+    module = f"$builddir/_buffer{sysconfig.get_config_var('EXT_SUFFIX')}"
+
+    ninja.build('$builddir/buffer_module.o', 'cxx', 'lib/cpp/buffer_module.cpp',
+                variables={'cppflags': f'$cppflags -fPIC -fvisibility=hidden {includes}'})
+    ninja.build(module, 'cxx-shared',
+                ['$builddir/buffer_module.o', '$builddir/buffer.o'])
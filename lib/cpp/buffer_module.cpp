@@ -0,0 +1,57 @@
+// Look at buffer.h for in depth documentation
+// pybind11 bindings for the frame-rate calls of buffer.h. Blocks are still
+// created, opened, and destroyed through the ctypes wrapper in accessor.py;
+// this module only wraps an existing block_t* handle.
+#include <pybind11/numpy.h>
+#include <pybind11/pybind11.h>
+
+#include <cstdint>
+#include <cstring>
+
+#include "../c/buffer.h"
+
+namespace py = pybind11;
+
+class Block {
+   public:
+    explicit Block(uintptr_t handle) : block_(reinterpret_cast<block_t*>(handle)) {}
+
+    // Copies [frame] into the inactive slot and publishes it. The GIL is released
+    // for the copy.
+    int write_frame(py::array_t<uint8_t, py::array::c_style | py::array::forcecast> frame,
+                    uint64_t acquisition_time) {
+        size_t image_size = block_image_size(block_);
+        if (static_cast<size_t>(frame.size()) != image_size) return FRAME_SIZE_MISMATCH;
+        const uint8_t* data = frame.data();
+
+        py::gil_scoped_release release;
+        image* slot = acquire_write_slot(block_);
+        if (slot == nullptr) return BLOCK_NOT_ACTIVE;
+        memcpy(slot, data, image_size);
+        return publish_write_slot(block_, acquisition_time);
+    }
+
+    // Waits like [::read_frame] for a frame newer than [frame_uid] and returns
+    // (exit_code, frame_uid, acquisition_time). The GIL is released while waiting.
+    py::tuple read_frame(uint64_t frame_uid, bool block_thread) {
+        frame_t frame = {};
+        frame.frame_uid = frame_uid;
+
+        int exit_code;
+        {
+            py::gil_scoped_release release;
+            exit_code = ::read_frame(block_, &frame, block_thread);
+        }
+        return py::make_tuple(exit_code, frame.frame_uid, frame.acquisition_time);
+    }
+
+   private:
+    block_t* block_;
+};
+
+PYBIND11_MODULE(_buffer, m) {
+    py::class_<Block>(m, "Block")
+        .def(py::init<uintptr_t>())
+        .def("write_frame", &Block::write_frame)
+        .def("read_frame", &Block::read_frame);
+}
@@ -1,3 +1,3 @@
 #!/bin/bash
-export PYTHONPATH=$PWD/lib/
+export PYTHONPATH=$PWD/lib/:$PWD/lib/binaries/
 export LD_LIBRARY_PATH=$PWD/lib/binaries
\ No newline at end of file